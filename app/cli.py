@@ -1,40 +1,73 @@
 # make this file last since this is where you actually use the database and tables
 
+import sys # lets us write straight to stdout in big chunks instead of one print per row
 from typing_extensions import Annotated # allows for default arguments in CLI commands (like limit and offset in get_paginated)
 
 # cli uses absolute addressing since it's a CLI and not a module, so we need to import from the app package instead of the current directory
 import typer # allows us to make CLI commands
-from app.database import create_db_and_tables, get_session, drop_all # carry over the database functions we made in database.py
-from app.models import User, Todo, Category, TodoCategory # carry over the User table we made in models.py
+from app.database import engine, create_db_and_tables, drop_all # carry over the engine and database functions we made in database.py
+from app.models import User, Todo, Category, TodoCategory, password_hash, select_user_by_username, select_user_id_by_username # carry over the User table we made in models.py
+from pydantic import ValidationError # raised by User.create when the username/email breaks the rules in models.py
 from fastapi import Depends # handles some ugly dependency injection for us
-from sqlmodel import select # allows us to run select queries on the database
-from sqlalchemy.exc import IntegrityError # allows us to catch database errors (like when we try to create a user with a username that already exists)
+from sqlmodel import Session, select, update, insert, delete, text # Session opens a connection to the database, the rest allows us to run select, update, insert and delete queries on the database, and raw SQL with text
+from sqlalchemy.exc import IntegrityError, OperationalError # 1-> a foreign key/unique rule was broken, 2-> what sqlite raises for things like a missing table or constraint
+from sqlalchemy.orm import selectinload # eager loading of relationships so we don't fire off one extra query per row (N+1)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert # sqlite's INSERT that supports ON CONFLICT, so we can skip duplicates in one statement instead of checking first
 
 cli = typer.Typer()
 
+# id of the user with this username (or None), most commands only need the id to filter/insert with so there's no point loading the whole user
+# no user cache here on purpose, every cli command is a fresh process so the cache would always start empty, it's for the server
+def _user_id(db: Session, username: str) -> int | None:
+    return db.exec(select_user_id_by_username, params={"username": username}).first()
+
+# wraps text in double quotes for an fts MATCH query so characters like - or * are searched for instead of treated as operators
+def _fts_phrase(value: str) -> str:
+    return '"' + value.replace('"', '""') + '"'
+
+# printed when a statement fails because database.db was made by an older version of this app, before the
+# ON DELETE CASCADE foreign keys and the unique (user_id, text) rule on categories were added
+_OLD_SCHEMA_MESSAGE = "Error: database.db was made by an older version of this app, run 'python -m app.cli initialize' to recreate it (this deletes all data)."
+
+# commands that only read from the database, they get a session without autoflush
+# (there's never anything to flush when we only read, so it skips checking for pending changes before every query)
+_READ_ONLY_COMMANDS = {"get-user", "get-all-users", "get-partial-user", "get-paginated", "list-todos", "list-user-categories", "list-todo-categories"}
+
+# runs before every command, it opens the one database session the command uses (ctx.obj), instead of every command opening and tearing down its own
+# with_resource closes the session when the command is finished, same as the with block would
+@cli.callback()
+def main(ctx: typer.Context):
+    ctx.obj = ctx.with_resource(Session(engine, autoflush=ctx.invoked_subcommand not in _READ_ONLY_COMMANDS))
+
 # how to use help= when there's no arguments, since the help text can't be attached to an argument in this case
 @cli.command(help="Initializes the database by creating tables and adding a default user (bob)")
-def initialize():
+def initialize(ctx: typer.Context, seed: Annotated[int, typer.Option(help="Number of extra test users (user0, user1, ...) to add")] = 0):
     '''
     Creates the database and tables, and adds a default user (bob) to the database. 
     
     Args:
-        None
+        seed: Number of extra test users to add, all with the password 'pw' (default is 0).
     
     Usage:
         python -m app.cli initialize
-    '''
-    with get_session() as db: # Get a connection to the database
-        drop_all() # delete all tables
-        create_db_and_tables() #recreate all tables
-        bob = User('bob', 'bob@mail.com', 'bobpass') # Create a new user (in memory)
-        db.add(bob) # Tell the database about this new data
-        db.commit() # Tell the database persist the data
-        db.refresh(bob) # Update the user (we use this to get the ID from the db)
-        print("Database Initialized")
+        python -m app.cli initialize --seed <n>
+    '''
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    drop_all() # delete all tables
+    create_db_and_tables() #recreate all tables
+    bob = User.create(username='bob', email='bob@mail.com', password='bobpass') # Create a new user (in memory)
+    db.add(bob) # Tell the database about this new data
+    db.commit() # Tell the database persist the data
+    db.refresh(bob) # Update the user (we use this to get the ID from the db)
+    if seed > 0:
+        hashed = password_hash.hash("pw") # hashing is slow on purpose, so do it once and share it between all the test users
+        rows = [{"username": f"user{i}", "email": f"user{i}@mail.com", "password": hashed} for i in range(seed)]
+        db.exec(insert(User), params=rows) # passing a list of rows sends them all in one executemany instead of one INSERT + commit per user
+        db.commit()
+    print("Database Initialized")
 
 @cli.command()
-def get_user(username: Annotated[str, typer.Argument(help="The username of the user to retrieve")]):
+def get_user(ctx: typer.Context, username: Annotated[str, typer.Argument(help="The username of the user to retrieve")]):
     '''
     Retrieve a user from the database by username.
 
@@ -44,15 +77,15 @@ def get_user(username: Annotated[str, typer.Argument(help="The username of the u
     Usage:
         python -m app.cli get-user <username>
     '''
-    with get_session() as db:  # Get a connection to the database
-        user = db.exec(select(User).where(User.username == username)).first() # Run a query to find the user with the given username
-        if not user:
-            print(f'{username} not found!')
-            return
-        print(user)
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    user = db.exec(select_user_by_username, params={"username": username}).first() # Find the user with the given username
+    if not user:
+        print(f'{username} not found!')
+        return
+    print(user)
 
 @cli.command(help="Retrieves all users from the database and prints their information")
-def get_all_users():
+def get_all_users(ctx: typer.Context):
     '''
     Retrieves all users from the database and prints their information.
     
@@ -62,17 +95,18 @@ def get_all_users():
     Usage:
         python -m app.cli get-all-users
     '''
-    with get_session() as db: # Get a connection to the database
-        all_users = db.exec(select(User)).all() # Run a query to get all users
-        if not all_users:
-            print("No users found")
-            return
-        else:
-            for user in all_users:
-                print(user)
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    found = False
+    # yield_per fetches and builds users 1000 at a time instead of loading the whole table into memory with .all()
+    # each chunk of 1000 gets written in one go, print() per user would lock and flush stdout for every single line
+    for users in db.exec(select(User).execution_options(yield_per=1000)).partitions():
+        found = True
+        sys.stdout.write("".join(f"{user}\n" for user in users))
+    if not found:
+        print("No users found")
 
 @cli.command()
-def change_email(username: Annotated[str, typer.Argument(help="The username of the user whose email is to be changed")], 
+def change_email(ctx: typer.Context, username: Annotated[str, typer.Argument(help="The username of the user whose email is to be changed")], 
                  new_email: Annotated[str, typer.Argument(help="The new email address for the user")]):
     '''
     Modifies the email address of a user in the database.
@@ -84,18 +118,18 @@ def change_email(username: Annotated[str, typer.Argument(help="The username of t
     Usage:
         python -m app.cli change-email <username> <new_email>
     '''
-    with get_session() as db:
-        user = db.exec(select(User).where(User.username == username)).first() # Run a query to find the user with the given username
-        if not user:
-            print(f'{username} not found! Unable to update email.')
-            return
-        user.email = new_email # Update the user's email
-        db.add(user) # Tell the database about this change
-        db.commit() # Tell the database to persist this change
-        print(f"Updated {user.username}'s email to {user.email}")
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    user = db.exec(select_user_by_username, params={"username": username}).first() # Run a query to find the user with the given username (not the cached one, since we're about to change it)
+    if not user:
+        print(f'{username} not found! Unable to update email.')
+        return
+    user.email = new_email # Update the user's email
+    db.add(user) # Tell the database about this change
+    db.commit() # Tell the database to persist this change
+    print(f"Updated {user.username}'s email to {user.email}")
 
 @cli.command()
-def create_user(username: Annotated[str, typer.Argument(help="The username of the new user")], 
+def create_user(ctx: typer.Context, username: Annotated[str, typer.Argument(help="The username of the new user")], 
                 email: Annotated[str, typer.Argument(help="The email address of the new user")], 
                 password: Annotated[str, typer.Argument(help="The password for the new user")]):
     '''
@@ -109,20 +143,24 @@ def create_user(username: Annotated[str, typer.Argument(help="The username of th
     Usage:
         python -m app.cli create-user <username> <email> <password>
     '''
-    with get_session() as db:
-        new_user = User(username, email, password) 
-        try:
-            db.add(new_user)
-            db.commit()
-        except IntegrityError as e:
-            db.rollback() # If there was an error, we need to rollback the transaction so we can try again
-            print(f"Error: A user with the username '{username}' already exists.")
-            return
-        else:
-            print(new_user)
-            
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    try:
+        new_user = User.create(username=username, email=email, password=password)
+    except ValidationError as e:
+        error = e.errors()[0]
+        print(f"Error: invalid {error['loc'][0]}, {error['msg']}.")
+        return
+    # ON CONFLICT DO NOTHING skips the insert if the username or email is taken, and RETURNING gives us the new id (or nothing if it was skipped)
+    new_user.id = db.exec(sqlite_insert(User).values(username=new_user.username, email=new_user.email, password=new_user.password)
+                          .on_conflict_do_nothing().returning(User.id)).scalar_one_or_none()
+    if new_user.id is None:
+        print(f"Error: A user with the username '{username}' or email '{email}' already exists.")
+        return
+    db.commit()
+    print(new_user)
+        
 @cli.command()
-def delete_user(username: Annotated[str, typer.Argument(help="The username of the user to delete")]):
+def delete_user(ctx: typer.Context, username: Annotated[str, typer.Argument(help="The username of the user to delete")]):
     '''
     Deletes a user from the database with the given username.
     
@@ -132,17 +170,22 @@ def delete_user(username: Annotated[str, typer.Argument(help="The username of th
     Usage:
         python -m app.cli delete-user <username>
     '''
-    with get_session() as db:
-        user = db.exec(select(User).where(User.username == username)).first() # Run a query to find the user with the given username
-        if not user:
-            print(f'{username} not found! Unable to delete user.')
-            return
-        db.delete(user)
-        db.commit()
-        print(f"Deleted user {username}")
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    # one DELETE statement, the database's ON DELETE CASCADE removes the user's todos and categories (no need to load anything first)
+    try:
+        result = db.exec(delete(User).where(User.username == username).execution_options(synchronize_session=False))
+    except IntegrityError: # the foreign keys don't have ON DELETE CASCADE, so a user with todos/categories can't be deleted
+        db.rollback()
+        print(_OLD_SCHEMA_MESSAGE)
+        return
+    if result.rowcount == 0:
+        print(f'{username} not found! Unable to delete user.')
+        return
+    db.commit()
+    print(f"Deleted user {username}")
 
 @cli.command()
-def get_partial_user(partial_username: Annotated[str, typer.Argument(help="The partial username to search for")], 
+def get_partial_user(ctx: typer.Context, partial_username: Annotated[str, typer.Argument(help="The partial username to search for")], 
                     partial_email: Annotated[str, typer.Argument(help="The partial email to search for")]):
     '''
     Gets a user from the database with a partially specified username or email.
@@ -154,17 +197,29 @@ def get_partial_user(partial_username: Annotated[str, typer.Argument(help="The p
     Usage:
         python -m app.cli get-partial-user <partial_username> <partial_email>
     '''
-    with get_session() as db:
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    searched = False
+    # the trigram index can only match 3 or more characters, and it only exists on sqlite
+    if len(partial_username) >= 3 and len(partial_email) >= 3 and db.get_bind().dialect.name == "sqlite":
+        # search the full text index (see user_fts in database.py) instead of scanning every user, quotes make fts treat the input as plain text
+        fts_query = f"username : {_fts_phrase(partial_username)} OR email : {_fts_phrase(partial_email)}"
+        try:
+            user_id = db.exec(text("SELECT rowid FROM user_fts WHERE user_fts MATCH :q LIMIT 1"), params={"q": fts_query}).scalar()
+            user = db.get(User, user_id) if user_id is not None else None
+            searched = True
+        except OperationalError: # no user_fts, the database is older than it, create_db_and_tables adds it without touching the data
+            db.rollback()
+    if not searched:
         user = db.exec(select(User).where(User.username.contains(partial_username) | User.email.contains(partial_email))).first() # where is just like the WHERE clause in SQL, so it can take an OR statement in the form of |, and the contains method can be used to search for partial matches in the username and email columns
-        if not user:
-            print(f'No user found with username containing "{partial_username}" or email containing "{partial_email}"')
-            return
-        print(user)
-        
-        
+    if not user:
+        print(f'No user found with username containing "{partial_username}" or email containing "{partial_email}"')
+        return
+    print(user)
+    
+    
 # how to specifically set default arguments in CLI commands, it's a different method from regular python function defaults
 @cli.command()
-def get_paginated(limit: Annotated[int, typer.Argument(help="The number of maximum number of users to return")] = 10, 
+def get_paginated(ctx: typer.Context, limit: Annotated[int, typer.Argument(help="The number of maximum number of users to return")] = 10, 
                   offset: Annotated[int, typer.Argument(help="The number of users to skip before starting to return results")] = 0):
     '''
     Gets a paginated list of users from the database.
@@ -176,16 +231,16 @@ def get_paginated(limit: Annotated[int, typer.Argument(help="The number of maxim
     Usage:
         python -m app.cli get-paginated <limit> <offset>
     '''
-    with get_session() as db:
-        users = db.exec(select(User).limit(limit).offset(offset)).all() # select -> get table with column, limit -> max entries to return, offset -> how many entries to skip before starting to return results
-        if not users:
-            print("No users found with the given pagination parameters.")
-            return
-        for user in users:
-            print(user)
-            
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    users = db.exec(select(User).limit(limit).offset(offset)).all() # select -> get table with column, limit -> max entries to return, offset -> how many entries to skip before starting to return results
+    if not users:
+        print("No users found with the given pagination parameters.")
+        return
+    for user in users:
+        print(user)
+        
 @cli.command()
-def add_task(username: Annotated[str, typer.Argument(help="The username of the user to add a task for")], 
+def add_task(ctx: typer.Context, username: Annotated[str, typer.Argument(help="The username of the user to add a task for")], 
              task: Annotated[str, typer.Argument(help="The text of the task to add")]):
     '''
     Adds a task to a user's list of tasks in the database.
@@ -197,19 +252,18 @@ def add_task(username: Annotated[str, typer.Argument(help="The username of the u
     Usage:
         python -m app.cli add-task <username> <task>
     '''
-    with get_session() as db:
-        user = db.exec(select(User).where(User.username == username)).one_or_none()
-        if not user:
-            print("User doesn't exist")
-            return
-        user.todos.append(Todo(text=task)) # so apparently it's possible to append objects to a list and calling capital T Todo will automatically create a new task in the database and link it to the user, so there's no need to manually create a new task and set the user_id to the user's id
-        db.add(user)
-        db.commit()
-        print("Task added for user")
-        
-        
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    user_id = _user_id(db, username)
+    if user_id is None:
+        print("User doesn't exist")
+        return
+    db.add(Todo(text=task, user_id=user_id)) # we only need the user's id, so we can set it directly instead of loading the user to append to user.todos
+    db.commit()
+    print("Task added for user")
+    
+    
 @cli.command()
-def toggle_todo(todo_id: Annotated[int, typer.Argument(help="The ID of the todo item to toggle")], 
+def toggle_todo(ctx: typer.Context, todo_id: Annotated[int, typer.Argument(help="The ID of the todo item to toggle")], 
                 username: Annotated[str, typer.Argument(help="The username of the user who owns the todo item")]):
     '''
     Toggles the done state of a todo item for a user in the database.
@@ -221,25 +275,24 @@ def toggle_todo(todo_id: Annotated[int, typer.Argument(help="The ID of the todo
     Usage:
         python -m app.cli toggle-todo <todo_id> <username>
     '''
-    with get_session() as db:
-        todo = db.exec(select(Todo).where(Todo.id == todo_id)).one_or_none()
-        if not todo:
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    # flip done in the database in one statement, but only if the todo belongs to the user, and get the new value back
+    # (instead of SELECT the todo, check the owner, then UPDATE it)
+    done = Todo.toggle_by_id(db, todo_id, username=username)
+    if done is None: # nothing was updated, only now do we need to figure out why
+        if db.exec(select(Todo.id).where(Todo.id == todo_id)).first() is None:
             print("This todo doesn't exist")
-            return
-        if todo.user.username != username: # only works because of the relationship between User and Todo
+        else:
             print(f"This todo doesn't belong to {username}")
-            return
-
-        todo.toggle()
-        db.add(todo)
-        db.commit()
+        return
+    db.commit()
 
-        print(f"Todo item's done state set to {todo.done}")
+    print(f"Todo item's done state set to {done}")
 
 # start from here tmr
 
 @cli.command()
-def list_todo_categories(todo_id: Annotated[int, typer.Argument(help="The ID of the todo item to list the categories")], 
+def list_todo_categories(ctx: typer.Context, todo_id: Annotated[int, typer.Argument(help="The ID of the todo item to list the categories")], 
                          username: Annotated[str, typer.Argument(help="The user of which the todo belongs to")]):
     '''
     Lists all the categories of a user's specified todo
@@ -251,17 +304,17 @@ def list_todo_categories(todo_id: Annotated[int, typer.Argument(help="The ID of
     Usage:
         python -m app.cli list-todo-categories <todo_id> <username>
     '''
-    with get_session() as db: # Get a connection to the database
-        todo = db.exec(select(Todo).where(Todo.id == todo_id)).one_or_none()
-        if not todo:
-            print("Todo doesn't exist")
-        elif not todo.user.username == username:
-            print("Todo doesn't belong to that user")
-        else:
-            print(f"Categories: {todo.categories}")
-            
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    todo = db.exec(select(Todo).options(selectinload(Todo.categories)).where(Todo.id == todo_id)).one_or_none() # one extra IN query for the many-to-many categories
+    if not todo:
+        print("Todo doesn't exist")
+    elif todo.user_id != _user_id(db, username):
+        print("Todo doesn't belong to that user")
+    else:
+        print(f"Categories: {todo.categories}")
+        
 @cli.command()
-def create_category(username: Annotated[str, typer.Argument(help="The username of to which the category belongs to")], 
+def create_category(ctx: typer.Context, username: Annotated[str, typer.Argument(help="The username of to which the category belongs to")], 
                     cat_text: Annotated[str, typer.Argument(help="The name of the new category")]):
     '''
     Allows a new category to be created and added to a specific user
@@ -273,25 +326,29 @@ def create_category(username: Annotated[str, typer.Argument(help="The username o
     Usage:
         python -m app.cli create-category <username> <cat_text>
     '''
-    with get_session() as db: # Get a connection to the database
-        user = db.exec(select(User).where(User.username == username)).one_or_none()
-        if not user:
-            print("User doesn't exist")
-            return
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    user_id = _user_id(db, username)
+    if user_id is None:
+        print("User doesn't exist")
+        return
 
-        category = db.exec(select(Category).where(Category.text== cat_text, Category.user_id == user.id)).one_or_none()
-        if category:
-            print("Category exists! Skipping creation")
-            return
-        
-        category = Category(text=cat_text, user_id=user.id)
-        db.add(category)
-        db.commit()
+    # insert and duplicate check in one statement, RETURNING gives back nothing if the category already existed
+    try:
+        category_id = db.exec(sqlite_insert(Category).values(text=cat_text, user_id=user_id)
+                              .on_conflict_do_nothing(index_elements=["user_id", "text"]).returning(Category.id)).scalar_one_or_none()
+    except OperationalError: # there's no unique (user_id, text) rule for ON CONFLICT to use
+        db.rollback()
+        print(_OLD_SCHEMA_MESSAGE)
+        return
+    if category_id is None:
+        print("Category exists! Skipping creation")
+        return
+    db.commit()
 
-        print("Category added for user")
-        
+    print("Category added for user")
+    
 @cli.command()
-def list_user_categories(username: Annotated[str, typer.Argument(help="The username of to which the categories belongs to")]):
+def list_user_categories(ctx: typer.Context, username: Annotated[str, typer.Argument(help="The username of to which the categories belongs to")]):
     '''
     Lists all the categories that belong to a user
     
@@ -302,16 +359,16 @@ def list_user_categories(username: Annotated[str, typer.Argument(help="The usern
         python -m app.cli list-user-categories <username>
     
     '''
-    with get_session() as db: # Get a connection to the database
-        user = db.exec(select(User).where(User.username == username)).one_or_none()
-        if not user:
-            print("User doesn't exist")
-            return
-        categories = db.exec(select(Category).where(Category.user_id == user.id)).all()
-        print([category.text for category in categories])
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    user_id = _user_id(db, username)
+    if user_id is None:
+        print("User doesn't exist")
+        return
+    category_names = db.exec(select(Category.text).where(Category.user_id == user_id)).all() # only select the text column, no need to build full Category objects just to print their names
+    print(category_names)
 
 @cli.command()
-def assign_category_to_todo(username: Annotated[str, typer.Argument(help="The username of to which the category belongs to")], 
+def assign_category_to_todo(ctx: typer.Context, username: Annotated[str, typer.Argument(help="The username of to which the category belongs to")], 
                             todo_id: Annotated[int, typer.Argument(help="The ID of the todo to assign the category")],
                             category_text: Annotated[str, typer.Argument(help="The new category to be assigned")]):
     '''
@@ -325,31 +382,42 @@ def assign_category_to_todo(username: Annotated[str, typer.Argument(help="The us
     Usage:
         python -m app.cli assign-category-to-todo <username> <todo_id> <category_text>
     '''
-    with get_session() as db: # Get a connection to the database
-        user = db.exec(select(User).where(User.username == username)).one_or_none()
-        if not user:
-            print("User doesn't exist")
-            return
-        
-        category = db.exec(select(Category).where(Category.text == category_text, Category.user_id==user.id)).one_or_none()
-        if not category:
-            category = Category(text=category_text, user_id=user.id)
-            db.add(category)
-            db.commit()
-            print("Category didn't exist for user, creating it")
-        
-        todo = db.exec(select(Todo).where(Todo.id == todo_id, Todo.user_id==user.id)).one_or_none()
-        if not todo:
-            print("Todo doesn't exist for user")
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    # look up the user, the user's todo and the user's category all in one query, the outer joins give back None for whichever of the todo/category is missing
+    row = db.exec(select(User.id, Todo.id, Category.id)
+                  .join(Todo, (Todo.user_id == User.id) & (Todo.id == todo_id), isouter=True)
+                  .join(Category, (Category.user_id == User.id) & (Category.text == category_text), isouter=True)
+                  .where(User.username == username)).first()
+    if row is None:
+        print("User doesn't exist")
+        return
+    user_id, found_todo_id, category_id = row
+    
+    if category_id is None:
+        # someone else could create the same category between the SELECT above and here, so insert it with ON CONFLICT DO UPDATE,
+        # which returns the id either way (DO NOTHING would return nothing if it already existed) in one statement
+        new_category = sqlite_insert(Category).values(text=category_text, user_id=user_id)
+        try:
+            category_id = db.exec(new_category.on_conflict_do_update(index_elements=["user_id", "text"], set_={"text": new_category.excluded.text})
+                                  .returning(Category.id)).scalar_one()
+        except OperationalError: # there's no unique (user_id, text) rule for ON CONFLICT to use
+            db.rollback()
+            print(_OLD_SCHEMA_MESSAGE)
             return
-        
-        todo.categories.append(category)
-        db.add(todo)
         db.commit()
-        print("Added category to todo")
-        
+        print("Category didn't exist for user, creating it")
+    
+    if found_todo_id is None:
+        print("Todo doesn't exist for user")
+        return
+    
+    # insert the link row directly instead of loading todo.categories to append to it, and do nothing if the todo already has this category
+    db.exec(sqlite_insert(TodoCategory).values(todo_id=found_todo_id, category_id=category_id).on_conflict_do_nothing())
+    db.commit()
+    print("Added category to todo")
+    
 @cli.command(help="Print all todos with ID, text, username, and done status.")
-def list_todos():
+def list_todos(ctx: typer.Context):
     '''
     Print all todos with ID, text, username, and done status.
     
@@ -359,13 +427,15 @@ def list_todos():
     Usage:
         python -m app.cli list-todos
     '''
-    with get_session() as db:
-        todos = db.exec(select(Todo)).all()
-        for todo in todos:
-            print(f"ID: {todo.id} | Text: {todo.text} | User: {todo.user.username} | Done: {todo.done}")
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    # join to get each todo's username in the same query, and only select the columns we print instead of building Todo and User objects
+    # yield_per streams the rows 1000 at a time, and each chunk gets written to stdout in one go instead of one print per row
+    todos = db.exec(select(Todo.id, Todo.text, User.username, Todo.done).join(User).execution_options(yield_per=1000))
+    for rows in todos.partitions():
+        sys.stdout.write("".join(f"ID: {todo_id} | Text: {todo_text} | User: {username} | Done: {done}\n" for todo_id, todo_text, username, done in rows))
 
 @cli.command()
-def delete_todo(todo_id: Annotated[int, typer.Argument(help="The ID of the todo to be deleted")]):
+def delete_todo(ctx: typer.Context, todo_id: Annotated[int, typer.Argument(help="The ID of the todo to be deleted")]):
     '''
     Delete a todo by its ID
     
@@ -375,17 +445,17 @@ def delete_todo(todo_id: Annotated[int, typer.Argument(help="The ID of the todo
     Usage:
         python -m app.cli delete-todo <todo_id>
     '''
-    with get_session() as db:
-        todo = db.exec(select(Todo).where(Todo.id == todo_id)).one_or_none()
-        if not todo:
-            print(f"Todo with ID {todo_id} does not exist")
-            return
-        db.delete(todo)
-        db.commit()
-        print(f"Todo with ID {todo_id} deleted")
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    # one DELETE statement, the database's ON DELETE CASCADE removes the todo's category links (the ORM would load todo.categories first to delete them itself)
+    result = db.exec(delete(Todo).where(Todo.id == todo_id).execution_options(synchronize_session=False))
+    if result.rowcount == 0:
+        print(f"Todo with ID {todo_id} does not exist")
+        return
+    db.commit()
+    print(f"Todo with ID {todo_id} deleted")
 
 @cli.command()
-def complete_all(username: Annotated[str, typer.Argument(help="The username of the user to mark all todos as done")]):
+def complete_all(ctx: typer.Context, username: Annotated[str, typer.Argument(help="The username of the user to mark all todos as done")]):
     '''
     Mark all todos of a specific user as done=True
     
@@ -395,18 +465,15 @@ def complete_all(username: Annotated[str, typer.Argument(help="The username of t
     Usage:
         python -m app.cli complete-all <username>
     '''
-    with get_session() as db:
-        user = db.exec(select(User).where(User.username == username)).one_or_none()
-        if not user:
-            print(f"User {username} does not exist")
-            return
+    db = ctx.obj # Get the connection to the database that main() opened for this command
+    user_id = _user_id(db, username)
+    if user_id is None:
+        print(f"User {username} does not exist")
+        return
 
-        for todo in user.todos:
-            todo.done = True
-            db.add(todo)
-
-        db.commit()
-        print(f"All todos for {username} marked as complete")
+    db.exec(update(Todo).where(Todo.user_id == user_id).values(done=True)) # one UPDATE for all of the user's todos instead of loading and updating them one by one
+    db.commit()
+    print(f"All todos for {username} marked as complete")
 
 if __name__ == "__main__":
     cli()
\ No newline at end of file
@@ -1,7 +1,9 @@
 # make this file second to create and connect to the database
 
+import os # read pool settings from environment variables
 from contextlib import contextmanager # janitor for cleaning up random database session junk
 from sqlmodel import Session, SQLModel, create_engine # 1-> allows the database to be created, 2-> allows us tables (classes) to be created, 3-> allows us to run queries
+from sqlalchemy import DDL, event # 1-> raw CREATE/DROP statements, 2-> lets us hook into things the engine does, like opening a new connection or creating a table
 from typing import Annotated # type hinting for fastapi endpoints
 from fastapi import Depends # handles some ugly dependency injection for us
 from . import models # connects the tables (classes) we created in models.py to the database
@@ -11,17 +13,82 @@ sqlite_url = f"sqlite:///{sqlite_file_name}" # actually making and finding the d
 
 # some fancy boilerplate to connect to the database and make sure it works with multiple threads (like when we run the server and cli at the same time)
 connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, connect_args=connect_args)
+
+# connection pool sizing, the defaults (5 + 10 overflow) are too small once the server and cli share the database
+# pre_ping checks a pooled connection is still alive before handing it out, so we don't stall on a dead one
+pool_size = int(os.getenv("DB_POOL_SIZE", "20")) # connections kept open in the pool
+max_overflow = int(os.getenv("DB_MAX_OVERFLOW", "30")) # extra connections allowed when the pool is busy
+pool_timeout = int(os.getenv("DB_POOL_TIMEOUT", "30")) # seconds to wait for a free connection before giving up
+
+# how many compiled statements the engine remembers, so repeated queries (including relationship loads) skip recompiling the SQL
+query_cache_size = int(os.getenv("DB_QUERY_CACHE_SIZE", "1200"))
+# DB_ECHO=1 logs every statement, each one is tagged with "[cached since ...]" or "[generated in ...]" so you can see if the cache is being hit
+echo = os.getenv("DB_ECHO") == "1"
+
+engine = create_engine(
+    sqlite_url,
+    connect_args=connect_args,
+    query_cache_size=query_cache_size,
+    echo=echo,
+    pool_size=pool_size,
+    max_overflow=max_overflow,
+    pool_timeout=pool_timeout,
+    pool_pre_ping=True,
+)
+
+# sqlite settings that only last as long as the connection, so they have to be set every time a new connection is opened
+sqlite_pragmas = (
+    "PRAGMA journal_mode=WAL", # readers don't block the writer (and vice versa) when the server and cli run at the same time
+    "PRAGMA synchronous=NORMAL", # safe with WAL and avoids an fsync on every commit
+    "PRAGMA temp_store=MEMORY", # temp tables and indexes live in memory instead of on disk
+    "PRAGMA cache_size=-64000", # negative means KiB, so ~64MB of page cache
+    "PRAGMA mmap_size=268435456", # memory map up to 256MB of the database file
+    "PRAGMA foreign_keys=ON", # sqlite ignores foreign keys (and ON DELETE CASCADE) unless this is turned on
+)
+
+# only on sqlite, other databases would choke on these (or worse, mean something else by them)
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma in sqlite_pragmas:
+        cursor.execute(pragma)
+    cursor.close()
+
+# full text search index over username and email, so partial matches don't have to scan the whole user table with LIKE '%...%'
+# content='user' means it reads the actual text from the user table and only stores the index, and the trigram tokenizer lets it match any substring of 3+ characters
+# sqlmodel doesn't know about virtual tables, so create_db_and_tables makes it (and the triggers that keep it in sync with every insert/update/delete) itself
+# IF NOT EXISTS so it can also add them to a database made before they existed, without touching the data
+user_fts_ddl = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5(username, email, content='user', content_rowid='id', tokenize='trigram')",
+    'CREATE TRIGGER IF NOT EXISTS user_fts_ai AFTER INSERT ON "user" BEGIN '
+    "INSERT INTO user_fts(rowid, username, email) VALUES (new.id, new.username, new.email); END",
+    'CREATE TRIGGER IF NOT EXISTS user_fts_ad AFTER DELETE ON "user" BEGIN '
+    "INSERT INTO user_fts(user_fts, rowid, username, email) VALUES ('delete', old.id, old.username, old.email); END",
+    'CREATE TRIGGER IF NOT EXISTS user_fts_au AFTER UPDATE ON "user" BEGIN '
+    "INSERT INTO user_fts(user_fts, rowid, username, email) VALUES ('delete', old.id, old.username, old.email); "
+    "INSERT INTO user_fts(rowid, username, email) VALUES (new.id, new.username, new.email); END",
+    "INSERT INTO user_fts(user_fts) VALUES('rebuild')", # (re)index every user already in the table, the triggers only catch changes from now on
+)
+# fts5 is sqlite only, execute_if skips it on any other database
+event.listen(models.User.__table__, "before_drop", DDL("DROP TABLE IF EXISTS user_fts").execute_if(dialect="sqlite")) # the triggers go away with the user table on their own
 
 # boilerplate tier code finally, we make the database and tables into something real with this function
+# safe to run on an existing database, it only adds what's missing
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    if engine.dialect.name == "sqlite": # fts5 is sqlite only
+        with engine.begin() as connection:
+            for statement in user_fts_ddl:
+                connection.execute(DDL(statement))
 
 # boilerplate tier code, mass delete, for testing purposes
 def drop_all():
     SQLModel.metadata.drop_all(bind=engine)
     
 # boilerplate tier code, we create a session to do things in it, automatically closes the session when we're done, so we don't have to worry about it
+# don't add parameters to this, SessionDep below would make fastapi turn them into query parameters on every endpoint that uses it
 @contextmanager
 def get_session():
     with Session(engine) as session:
@@ -1,6 +1,17 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from .database import create_db_and_tables
-app = FastAPI()
+from .models import prewarm_password_hash
+
+
+# runs once when the server starts, gets password hashing warmed up (and the dummy hash made) before the first request comes in
+# always on, otherwise the first "user not found" login has to make the dummy hash too and takes twice as long as a wrong password
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    prewarm_password_hash()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get('/')
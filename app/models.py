@@ -1,55 +1,253 @@
 # make this file first to define the tables
 
-from sqlmodel import Field, SQLModel, Relationship # 1-> defines the columns, 2-> allows us to make tables (classes), 3-> allows us to define relationships between classes/tables 
-from typing import Optional # database handles the primary key for optional makes it so we can define the id in the class but then forgot about it
+from sqlmodel import Field, SQLModel, Relationship, UniqueConstraint, Index # 1-> defines the columns, 2-> allows us to make tables (classes), 3-> allows us to define relationships between classes/tables, 4-> makes a combination of columns unique, 5-> index over one or more columns 
+from sqlmodel import Session, select, update # for the queries the models run themselves (like Todo.toggle_by_id)
+from sqlalchemy import bindparam # placeholder for a value that gets filled in when the query runs
+from sqlalchemy import event, false, inspect, text as sql_text # 1-> hooks for when rows get updated/deleted, 2-> database side false (0 on sqlite, false on postgres), 3-> look at an object's change history, 4-> raw SQL conditions (renamed since the models have a text column)
+from sqlalchemy.orm import make_transient_to_detached # marks a copy as an existing row (has an id) instead of a new one to INSERT
+from typing import Annotated, Optional # 1-> attaches extra rules to a type, 2-> database handles the primary key for optional makes it so we can define the id in the class but then forgot about it
+from pydantic import StringConstraints # length/pattern rules for strings, checked by pydantic's compiled (rust) validator instead of python code
+import os # read the password hashing profile from an environment variable
+import threading # lock for the user cache, since fastapi runs sync endpoints on several threads at once
+from functools import cache # remembers the result of a function after the first call
 from pwdlib import PasswordHash # password hashing
+from pwdlib.hashers.argon2 import Argon2Hasher # lets us pick our own argon2 cost settings
+from cachetools import TTLCache # dict that forgets entries after a while, for the user cache at the bottom
+from argon2 import extract_parameters # reads the cost settings stored inside an argon2 hash
+from argon2.exceptions import InvalidHashError # what extract_parameters raises for something that isn't an argon2 hash
 
-password_hash = PasswordHash.recommended()
+# argon2id cost settings, bump these over time as hardware gets faster (existing hashes keep working, they store their own settings)
+# OWASP's 46 MiB / 2 passes / 1 thread config, gets almost all the protection of the much heavier defaults for a fraction of the time and memory per hash
+ARGON2_MEMORY_COST = 47104 # KiB, so 46 MiB
+ARGON2_TIME_COST = 2 # passes over the memory
+ARGON2_PARALLELISM = 1 # threads
+ARGON2_HASH_LEN = 32 # bytes
+ARGON2_SALT_LEN = 16 # bytes
+
+# password_hash is made once here, always import this one instead of making a new PasswordHash (e.g. per request), setting it up isn't free
+# PWD_HASH_PROFILE=fast swaps in very cheap argon2 settings so seeding/testing isn't stuck waiting on every hash
+# never use it in production, the settings above are what actually make the hashes hard to crack
+if os.getenv("PWD_HASH_PROFILE") == "fast":
+    password_hash = PasswordHash((Argon2Hasher(time_cost=1, memory_cost=8, parallelism=1),))
+else:
+    password_hash = PasswordHash((Argon2Hasher(memory_cost=ARGON2_MEMORY_COST, time_cost=ARGON2_TIME_COST, parallelism=ARGON2_PARALLELISM,
+                                               hash_len=ARGON2_HASH_LEN, salt_len=ARGON2_SALT_LEN),))
+
+# usernames are 3+ characters of letters, numbers, _ . and - (the max length stays on the Field since that's where sqlmodel gets the VARCHAR size from)
+# only checked when a user is made through User.create/User.from_hash, see the comment there
+Username = Annotated[str, StringConstraints(min_length=3, pattern=r"^[a-zA-Z0-9_.-]+$")]
+
+# RAISE_ON_LAZY_LOAD=1 (dev/testing) makes Todo.categories throw an error instead of quietly running a query when it wasn't loaded up front
+# so a missing .options(selectinload(Todo.categories)) shows up as a crash instead of as an N+1 in production
+categories_lazy = "raise_on_sql" if os.getenv("RAISE_ON_LAZY_LOAD") else "selectin"
+
+# ALLOW_HASH_CACHE=1 remembers the hash of each password so re-running initialize or seeding lots of users with the same password only hashes it once
+# dev/testing only! every user with the same password ends up with the exact same hash (same salt), which is exactly what hashing is supposed to prevent
+_HASH_CACHE: dict[str, str] = {}
+
+# a real hash to check against when a login names a user that doesn't exist, see User.dummy_verify
+# not made at import so cli commands that never log anyone in don't pay for a hash on startup, the server makes it at startup
+# instead (prewarm_password_hash in main.py's lifespan), anything else that uses dummy_verify should call prewarm_password_hash first
+@cache
+def _dummy_hash() -> str:
+    return password_hash.hash("unused")
+
+# runs one real hash up front (the dummy one above, so it's not wasted) so the first login doesn't also pay for loading
+# the argon2 library and grabbing its ~46 MiB of working memory, and so dummy_verify is as slow as a wrong password from its first call
+def prewarm_password_hash() -> None:
+    _dummy_hash()
+
+# True if new_hash costs at least as much as old_hash in every setting and more in at least one
+def _is_stronger(new_hash: str, old_hash: str) -> bool:
+    try:
+        old = extract_parameters(old_hash)
+    except InvalidHashError: # not an argon2 hash (or a broken one), anything argon2 is better
+        return True
+    new = extract_parameters(new_hash)
+    new_costs = (new.memory_cost, new.time_cost, new.parallelism, new.hash_len, new.salt_len)
+    old_costs = (old.memory_cost, old.time_cost, old.parallelism, old.hash_len, old.salt_len)
+    return all(n >= o for n, o in zip(new_costs, old_costs)) and new_costs != old_costs
 
 class User(SQLModel, table=True):
     id: Optional[int] =  Field(default=None, primary_key=True)
-    username:str = Field(index=True, unique=True)
-    email:str = Field(index=True, unique=True)
-    password:str
+    # max_length makes these VARCHAR(n) columns instead of unbounded ones, keeps rows and indexes small
+    username:Username = Field(index=True, unique=True, max_length=32)
+    email:str = Field(index=True, unique=True, max_length=254) # longest email address allowed
+    password:str = Field(max_length=128, repr=False) # argon2id hashes come out around 100 characters, with some room for stronger settings later, repr=False keeps the hash out of logs and error messages
     
     # capital T so refers to the python class since we're defining the relationship between the two tables, 
     # not defining the column in the database. if we were defining the column in the database, 
     # then we would use lowercase t and refer to the table name, as seen in Todo class where 
     # we refer to the user table with lowercase u
-    todos: list['Todo'] = Relationship(back_populates="user") # relationship between the two tables, back_populates is used to define the relationship in the other table
+    todos: list['Todo'] = Relationship(back_populates="user", passive_deletes=True) # relationship between the two tables, back_populates is used to define the relationship in the other table
+    # passive_deletes leaves deleting a user's todos to the database's ON DELETE CASCADE instead of loading and updating them one by one
     # datatype of Todo, list['...'] is notify that it's a list
     
-    def __init__(self, username, email, password):
-        self.username = username
-        self.email = email
-        self.set_password(password)
+    # use this to make a new user from a plain text password, User(...) itself is left as sqlmodel's own constructor
+    # so loading users from the database (or building them from an existing hash) never runs the slow password hashing
+    # sqlmodel's constructor doesn't validate table models, so create() and from_hash() go through model_validate, which
+    # checks the Username rules and column lengths (raises pydantic's ValidationError), before any hashing is done
+    @classmethod
+    def create(cls, *, username: str, email: str, password: str) -> "User":
+        user = cls.model_validate({"username": username, "email": email, "password": ""})
+        user.set_password(password)
+        return user
+
+    # make a user from a password that's already hashed (imports, test fixtures), skips hashing completely
+    # plain text passwords must go through create() or set_password() instead, this stores whatever it's given as is
+    @classmethod
+    def from_hash(cls, *, username: str, email: str, encoded_hash: str) -> "User":
+        return cls.model_validate({"username": username, "email": email, "password": encoded_hash})
         
     def set_password(self, password):
-        self.password = password_hash.hash(password)
+        forget_user(self.id, self.username) # cached copies of this user would still have the old hash
+        if os.getenv("ALLOW_HASH_CACHE"):
+            if password not in _HASH_CACHE:
+                _HASH_CACHE[password] = password_hash.hash(password)
+            self.password = _HASH_CACHE[password]
+        else:
+            self.password = password_hash.hash(password)
+
+    # check a login attempt, always use this instead of hashing the attempt and comparing it with == (argon2 compares in constant time, so it doesn't leak how close the guess was)
+    # if the stored hash was made with older/weaker settings than the ones above, it gets swapped for a new hash (the caller still has to commit)
+    # only ever upgrades: pwdlib rehashes on any settings mismatch, so under PWD_HASH_PROFILE=fast it would otherwise swap a strong hash for a cheap one
+    def verify_password(self, password: str) -> bool:
+        valid, updated_hash = password_hash.verify_and_update(password, self.password)
+        if valid and updated_hash is not None and _is_stronger(updated_hash, self.password):
+            self.password = updated_hash
+        return valid
+
+    # call this on the "user not found" path of a login, it does the same argon2 work as verify_password
+    # so a missing user takes as long as a wrong password and response times don't give away which usernames exist
+    @staticmethod
+    def dummy_verify() -> None:
+        password_hash.verify("unused", _dummy_hash())
         
     def __str__(self) -> str:
         return f"(User id={self.id}, username={self.username}, email={self.email})"
  
 class TodoCategory(SQLModel, table=True):
-    todo_id: int|None = Field(primary_key=True, foreign_key='todo.id')
-    category_id: int|None = Field(primary_key=True, foreign_key='category.id')   
+    # the primary key already indexes (todo_id, category_id) for going todo -> categories, this covers going category -> todos
+    __table_args__ = (Index("ix_todocat_cat_todo", "category_id", "todo_id"),)
+
+    # ondelete="CASCADE" lets the database remove the link rows itself when a todo or category is deleted
+    todo_id: int|None = Field(primary_key=True, foreign_key='todo.id', ondelete="CASCADE")
+    category_id: int|None = Field(primary_key=True, foreign_key='category.id', ondelete="CASCADE")   
 
 class Todo(SQLModel, table=True):
+    # indexes for "show a user's todos" and "show a user's open todos", different per database (ddl_if only creates each one on the one named):
+    # postgres -> a plain user_id index, plus a partial user_id index that only holds the rows that aren't done yet, so it stays as small as the open list
+    #             the trade-off: postgres counts columns in an index's WHERE as indexed, so toggling done can't be a HOT update
+    #             (every toggle adds entries to the todo indexes, and a done -> not done flip adds the row back into ix_todo_user_open),
+    #             we pay that on toggles to get a small index for the open-todos read
+    # sqlite -> one (user_id, done) index, it also covers plain user_id lookups (and the foreign key) so there's no separate user_id index
+    # postgresql_with fillfactor=80 leaves 20% of every page free on postgres, so a toggle can usually still put the new row version on the
+    # same page (cheaper to write and read back), it doesn't save the index writes since those toggles aren't HOT, sqlite ignores it
+    __table_args__ = (
+        Index("ix_todo_user_id", "user_id").ddl_if(dialect="postgresql"),
+        Index("ix_todo_user_open", "user_id", postgresql_where=sql_text("done = false")).ddl_if(dialect="postgresql"),
+        Index("ix_todo_user_done", "user_id", "done").ddl_if(dialect="sqlite"),
+        {"postgresql_with": {"fillfactor": 80}},
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    user_id: int = Field(foreign_key="user.id") # common u so refers to table name and then column name
+    user_id: int = Field(foreign_key="user.id", ondelete="CASCADE") # common u so refers to table name and then column name, deleting the user deletes their todos (indexed in __table_args__ above)
     text: str = Field(max_length=255)
-    done: bool = Field(default=False)
+    done: bool = Field(default=False, sa_column_kwargs={"server_default": false()}) # server_default means the database fills it in too, not just python
     
     # column_name: datatype (can also be a class, hence capital U, for relationships) = Relationship(back_populates="column_name") column name so hence lowercase
-    user: User = Relationship(back_populates="todos") # relationship between the two tables, back_populates is used to define the relationship in the other table   
-    categories: list['Category'] = Relationship(back_populates=("todos"), link_model=TodoCategory)
+    user: User = Relationship(back_populates="todos", sa_relationship_kwargs={"lazy": "joined"}) # relationship between the two tables, back_populates is used to define the relationship in the other table   
+    categories: list['Category'] = Relationship(back_populates=("todos"), link_model=TodoCategory, sa_relationship_kwargs={"lazy": categories_lazy})
+    # lazy= picks how the related rows get loaded when a Todo is loaded, so looping over todos never fires one query per todo (N+1)
+    # joined -> the one user comes back in the same query with a JOIN, selectin -> all the todos' categories come back in one extra WHERE ... IN (...) query
+    # User.todos and Category.todos stay lazy on purpose, eager loading them would drag in every todo a user/category has whenever we just print a user or category
     
     def toggle(self):
         self.done = not self.done
+
+    # flips done in the database with one UPDATE ... SET done = NOT done instead of loading the todo, calling toggle() and saving it
+    # pass username to only toggle it if it belongs to that user, returns the new done value, or None if nothing was toggled (the caller still has to commit)
+    @classmethod
+    def toggle_by_id(cls, session: Session, todo_id: int, username: str | None = None) -> bool | None:
+        statement = update(cls).where(cls.id == todo_id)
+        if username is not None:
+            statement = statement.where(cls.user_id == select(User.id).where(User.username == username).scalar_subquery())
+        return session.exec(statement.values(done=~cls.done).returning(cls.done)).scalar_one_or_none()
     
 class Category(SQLModel, table=True):
+    # a user can't have two categories with the same name, this also gives us an index on (user_id, text) for lookups and ON CONFLICT inserts
+    __table_args__ = (UniqueConstraint("user_id", "text", name="uq_cat_user_text"),)
+
     id: Optional[int] =  Field(default=None, primary_key=True)
-    user_id: int = Field(foreign_key='user.id') #set user_id as a foreign key to user.id 
+    user_id: int = Field(foreign_key='user.id', ondelete="CASCADE") #set user_id as a foreign key to user.id, deleting the user deletes their categories
     text: str = Field(max_length=255)
 
-    todos: list['Todo'] = Relationship(back_populates=("categories"), link_model=TodoCategory)
\ No newline at end of file
+    todos: list['Todo'] = Relationship(back_populates=("categories"), link_model=TodoCategory)
+
+
+# the user-by-username lookup runs on almost every request/command, so it's built once here instead of every time
+# bindparam("username") is filled in with params={"username": ...} when the query is run, and the compiled SQL gets reused every time
+select_user_by_username = select(User).where(User.username == bindparam("username"))
+# same lookup but only the id, for when that's all that's needed (no User object to build)
+select_user_id_by_username = select(User.id).where(User.username == bindparam("username"))
+
+# in-process cache of users, so looking up the same user over and over (every request starts with one) skips the SELECT
+# it's for the server, the cli looks users up directly since each command is a fresh process and the cache would always start empty
+# the cache holds detached copies that never belong to any session, the getters hand back the session's own instance of the user
+# (session.merge(..., load=False) copies the cached columns into the session without running a query), so it can be changed, saved
+# or used in relationships like a normally loaded user
+# entries expire after 60 seconds, and get dropped right away when a user is updated/deleted through the ORM or changes their password
+# bulk UPDATE/DELETE statements skip the ORM, so after those call forget_user or clear_user_cache yourself
+_users_by_id: TTLCache = TTLCache(maxsize=4096, ttl=60)
+_user_ids_by_username: TTLCache = TTLCache(maxsize=4096, ttl=60)
+# TTLCache isn't thread safe (even a get can evict expired entries), so every read/write of the two caches goes through this lock
+# the database queries happen outside of it so one slow lookup doesn't hold up everyone else
+_user_cache_lock = threading.Lock()
+
+def _remember_user(user: User) -> None:
+    copy = User(**user.model_dump()) # copy of just the columns that isn't tied to the session, so it still works after that session is closed
+    make_transient_to_detached(copy) # it's a row that already exists, without this adding it to a session would try to INSERT it again
+    with _user_cache_lock:
+        _users_by_id[copy.id] = copy
+        _user_ids_by_username[copy.username] = copy.id
+
+def get_user_by_id(session: Session, user_id: int) -> User | None:
+    with _user_cache_lock:
+        cached = _users_by_id.get(user_id)
+    if cached is not None:
+        return session.merge(cached, load=False)
+    user = session.get(User, user_id)
+    if user is not None: # misses aren't cached, so a new user shows up right away
+        _remember_user(user)
+    return user
+
+def get_user_by_username(session: Session, username: str) -> User | None:
+    with _user_cache_lock:
+        user_id = _user_ids_by_username.get(username)
+        cached = _users_by_id.get(user_id) if user_id is not None else None
+    if cached is not None:
+        return session.merge(cached, load=False)
+    user = session.exec(select_user_by_username, params={"username": username}).first()
+    if user is not None:
+        _remember_user(user)
+    return user
+
+def forget_user(user_id: int | None = None, username: str | None = None) -> None:
+    with _user_cache_lock:
+        if username is not None:
+            user_id = _user_ids_by_username.pop(username, user_id)
+        if user_id is not None:
+            _users_by_id.pop(user_id, None)
+
+def clear_user_cache() -> None:
+    with _user_cache_lock:
+        _users_by_id.clear()
+        _user_ids_by_username.clear()
+
+# drop a user from the cache whenever the ORM saves a change to them or deletes them
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _forget_changed_user(mapper, connection, target: User) -> None:
+    forget_user(target.id, target.username)
+    for old_username in inspect(target).attrs.username.history.deleted: # the username itself might be what changed
+        forget_user(username=old_username)
@@ -0,0 +1,50 @@
+# shared fixtures for the tests, pytest picks this file up on its own
+
+import os
+import subprocess # runs the cli the same way you would from a terminal
+import sys
+from contextlib import contextmanager # lets count_queries be used as a with block
+from pathlib import Path
+import pytest
+from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy import event # hooks into every statement the engine runs, for counting them
+from app import models # registers the tables on SQLModel.metadata
+
+# a fresh sqlite database file per test, so tests never see each other's rows (or the real database.db)
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    SQLModel.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def session(engine):
+    models.clear_user_cache() # the user cache lives for the whole process, so don't let users from an earlier test leak in
+    with Session(engine) as session:
+        yield session
+
+# with count_queries() as queries: ... then len(queries) is how many SQL statements ran inside the block
+@pytest.fixture
+def count_queries(engine):
+    @contextmanager
+    def counter():
+        statements: list[str] = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+    return counter
+
+# runs cli commands with RAISE_ON_LAZY_LOAD=1, so any relationship a command forgot to load up front crashes it instead of running an extra query
+# the setting is read when app.models is imported, and this test process already imported it without the flag,
+# so every command runs in its own python process (which is how the cli runs anyway), in an empty folder so it gets its own database.db
+@pytest.fixture
+def raiseload_cli(tmp_path):
+    env = {**os.environ, "RAISE_ON_LAZY_LOAD": "1", "PWD_HASH_PROFILE": "fast", "PYTHONPATH": str(Path(__file__).parent.parent)}
+    def run(*args: str) -> subprocess.CompletedProcess:
+        return subprocess.run([sys.executable, "-m", "app.cli", *args], cwd=tmp_path, env=env, capture_output=True, text=True)
+    return run
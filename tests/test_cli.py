@@ -0,0 +1,13 @@
+# every command that reads todos and their categories, run with lazy loading turned into an error (see raiseload_cli in conftest.py)
+def test_list_commands_load_everything_up_front(raiseload_cli):
+    for setup in (("initialize",), ("add-task", "bob", "first"), ("add-task", "bob", "second"),
+                  ("create-category", "bob", "work"), ("assign-category-to-todo", "bob", "1", "work")):
+        assert raiseload_cli(*setup).returncode == 0, setup
+
+    for command in (("list-todos",), ("get-all-users",), ("list-user-categories", "bob"),
+                    ("list-todo-categories", "1", "bob"), ("delete-todo", "2"), ("list-todos",)):
+        result = raiseload_cli(*command)
+        assert result.returncode == 0, f"{command}: {result.stderr}"
+
+    assert "work" in raiseload_cli("list-todo-categories", "1", "bob").stdout
+    assert "second" not in raiseload_cli("list-todos").stdout
@@ -0,0 +1,32 @@
+import time
+from app import models
+from app.main import app, lifespan
+from app.models import User, password_hash
+
+# time of the first dummy_verify and the fastest of a few failed verify_password calls, in a freshly started app
+async def _first_dummy_and_failed_verify_times() -> tuple[float, float]:
+    models._dummy_hash.cache_clear() # pretend this is a fresh process
+    async with lifespan(app):
+        bob = User.from_hash(username="bob", email="bob@mail.com", encoded_hash=password_hash.hash("bobpass"))
+
+        start = time.perf_counter()
+        User.dummy_verify()
+        dummy_time = time.perf_counter() - start
+
+        verify_times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            assert not bob.verify_password("wrong")
+            verify_times.append(time.perf_counter() - start)
+    return dummy_time, min(verify_times)
+
+# the first dummy_verify after startup has to cost about the same as a wrong password, otherwise the first login
+# for a username that doesn't exist takes longer and gives away that it doesn't exist
+async def test_first_dummy_verify_after_startup_costs_about_a_failed_verify():
+    # building the dummy hash on the first call would make it about twice as slow every time,
+    # a few tries keeps a busy machine from failing the test on one slow sample
+    for _ in range(3):
+        dummy_time, verify_time = await _first_dummy_and_failed_verify_times()
+        if dummy_time < 1.5 * verify_time:
+            return
+    assert dummy_time < 1.5 * verify_time
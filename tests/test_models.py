@@ -0,0 +1,93 @@
+from pwdlib import PasswordHash
+from pwdlib.hashers.argon2 import Argon2Hasher
+from sqlmodel import Session, delete, select
+from app import models
+from app.models import User, Todo, Category, get_user_by_id, get_user_by_username, forget_user
+
+# Todo.user is joined and Todo.categories is selectin, so a user's todos with their owner and categories is
+# one query for the todos (+ the user, joined) and one for all their categories, no matter how many todos there are
+def test_loading_todos_with_categories_takes_at_most_two_queries(session, count_queries):
+    bob = User.from_hash(username="bob", email="bob@mail.com", encoded_hash="not-a-real-hash")
+    session.add(bob)
+    session.commit()
+    bob_id = bob.id
+    work = Category(text="work", user_id=bob_id)
+    home = Category(text="home", user_id=bob_id)
+    session.add_all(Todo(text=f"todo {i}", user_id=bob_id, categories=[work, home] if i % 2 else [work]) for i in range(10))
+    session.commit()
+    session.expunge_all() # start from nothing loaded, like a fresh request would
+
+    with count_queries() as queries:
+        todos = session.exec(select(Todo).where(Todo.user_id == bob_id)).all()
+        loaded = [(todo.user.username, sorted(category.text for category in todo.categories)) for todo in todos]
+
+    assert len(loaded) == 10
+    assert loaded[1] == ("bob", ["home", "work"])
+    assert len(queries) <= 2
+
+def _add_bob(session) -> int:
+    bob = User.from_hash(username="bob", email="bob@mail.com", encoded_hash="not-a-real-hash")
+    session.add(bob)
+    session.commit()
+    return bob.id
+
+# a user that came out of the cache belongs to the session that asked for it, so it can be used like a normally loaded user
+def test_cached_user_can_be_attached_to_a_new_todo(engine, session, count_queries):
+    bob_id = _add_bob(session)
+    get_user_by_username(session, "bob") # miss, loads and caches bob
+
+    with Session(engine) as other_session:
+        with count_queries() as queries:
+            bob = get_user_by_username(other_session, "bob")
+        assert queries == [] # came from the cache
+        other_session.add(Todo(text="x", user=bob))
+        other_session.commit() # used to INSERT bob a second time (UNIQUE constraint failed: user.id)
+
+    assert session.exec(select(Todo.user_id)).all() == [bob_id]
+
+def test_set_password_forgets_the_cached_user(session):
+    bob_id = _add_bob(session)
+    bob = get_user_by_username(session, "bob")
+    bob.set_password("new password")
+    assert bob_id not in models._users_by_id
+    assert "bob" not in models._user_ids_by_username
+
+def test_orm_update_forgets_the_cached_user(session, count_queries):
+    bob_id = _add_bob(session)
+    bob = get_user_by_username(session, "bob")
+    bob.username = "robert"
+    session.commit()
+
+    assert bob_id not in models._users_by_id
+    assert "bob" not in models._user_ids_by_username # the old username can't still point at bob
+    with count_queries() as queries:
+        assert get_user_by_username(session, "bob") is None
+    assert len(queries) == 1 # went to the database instead of the cache
+    assert get_user_by_id(session, bob_id).username == "robert"
+
+def test_forget_user_after_bulk_delete(session):
+    _add_bob(session)
+    get_user_by_username(session, "bob")
+    session.exec(delete(User).where(User.username == "bob"))
+    session.commit()
+    forget_user(username="bob") # bulk DELETE skips the ORM events, so the caller has to do this
+    assert get_user_by_username(session, "bob") is None
+
+# the PWD_HASH_PROFILE=fast settings and the real ones from models.py, swapped in for models.password_hash below
+fast_hash = PasswordHash((Argon2Hasher(time_cost=1, memory_cost=8, parallelism=1),))
+tuned_hash = PasswordHash((Argon2Hasher(memory_cost=models.ARGON2_MEMORY_COST, time_cost=models.ARGON2_TIME_COST, parallelism=models.ARGON2_PARALLELISM,
+                                        hash_len=models.ARGON2_HASH_LEN, salt_len=models.ARGON2_SALT_LEN),))
+
+def test_verify_password_never_downgrades_a_tuned_hash(monkeypatch):
+    tuned = tuned_hash.hash("bobpass")
+    bob = User.from_hash(username="bob", email="bob@mail.com", encoded_hash=tuned)
+    monkeypatch.setattr(models, "password_hash", fast_hash) # running with PWD_HASH_PROFILE=fast
+    assert bob.verify_password("bobpass")
+    assert bob.password == tuned
+
+def test_verify_password_upgrades_a_fast_hash(monkeypatch):
+    bob = User.from_hash(username="bob", email="bob@mail.com", encoded_hash=fast_hash.hash("bobpass"))
+    monkeypatch.setattr(models, "password_hash", tuned_hash)
+    assert bob.verify_password("bobpass")
+    assert f"m={models.ARGON2_MEMORY_COST},t={models.ARGON2_TIME_COST},p={models.ARGON2_PARALLELISM}" in bob.password
+    assert tuned_hash.verify("bobpass", bob.password)